@@ -1,11 +1,17 @@
+import argparse
 import sys
 from .backup import Backup
 
 
 def main():
-    try:
-        Backup(settings_file=sys.argv[1], extra_arguments=sys.argv[2:])
-    except:
-        Backup(settings_file=sys.argv[1], extra_arguments=[])
+    parser = argparse.ArgumentParser(prog='pyrsync')
+    parser.add_argument('settings_file', help='backup settings (ini file)')
+    parser.add_argument('rsync_args', nargs=argparse.REMAINDER,
+                        help='extra options passed on to rsync, e.g. --dry-run')
+    args = parser.parse_args()
+
+    backup = Backup(settings_file=args.settings_file, extra_arguments=args.rsync_args)
+    if backup.failed:
+        sys.exit(1)
 if __name__ == '__main__':
     main()
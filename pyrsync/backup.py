@@ -4,12 +4,27 @@ Performs rsync backup from MacBook to Synology diskstation
 """
 import os
 import sys
+import atexit
+import queue
+import selectors
+import threading
 from datetime import datetime
 import configparser
+import functools
 import hashlib
+import ipaddress
+import json
+import shlex
+import shutil
+import socket
 import subprocess
+import tempfile
+import time
+from pathlib import PurePosixPath
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from wakeonlan import send_magic_packet
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from . import rotate
 
 
@@ -24,6 +39,40 @@ class c:
     UNDERLINE = '\033[4m'
     DIM = '\033[2m'
 
+    # Common combinations, concatenated once
+    HEADER_BOLD = HEADER + BOLD
+    OKBLUE_BOLD = OKBLUE + BOLD
+    OKGREEN_BOLD = OKGREEN + BOLD
+    WARNING_BOLD = WARNING + BOLD
+    FAIL_BOLD = FAIL + BOLD
+
+
+if not sys.stdout.isatty():
+    # No escape codes when the output is redirected (cron, log files)
+    for name in [name for name in vars(c) if name.isupper()]:
+        setattr(c, name, '')
+
+
+SSH_PORT = 22
+
+# Default seconds to wait for a host to come up after a wake-on-LAN packet
+WAKE_TIMEOUT = 30
+
+# Options used for every rsync run
+RSYNC_BASE = (
+    "rsync",
+    "--recursive",
+    "--links",
+    "--hard-links",
+    "--times",
+    "--devices",
+    "--specials",
+    "--delete",
+    "--human-readable",
+    "--delete-excluded",
+    "--stats"
+)
+
 
 class Backup():
     """Backup Script.
@@ -41,9 +90,9 @@ class Backup():
         self.live = False
 
         if settings_file != '':
-            self.settings = configparser.ConfigParser()
-            self.settings._interpolation = configparser.ExtendedInterpolation()
-            self.settings.read(os.path.join(settings_file))
+            # Every section resolved into a plain dict, later lookups
+            # do not go through the interpolation again
+            self.config = self.read_settings(settings_file)
 
             # Store extra rsync arguments
             self.extra_arguments = extra_arguments
@@ -52,84 +101,213 @@ class Backup():
             else:
                 self.dry_run = False
 
-            # Current time
-            self.start = datetime.now().strftime('%Y-%m-%d (%H:%M:%S)')
+            # Current time, all backup sets of this run share its date
+            self.now = datetime.now()
+            self.start = self.now.strftime('%Y-%m-%d (%H:%M:%S)')
+            self.new_id = self.now.strftime('%Y-%m-%d')
 
             self.start_backups()
 
+    def read_settings(self, settings_file):
+        """Return the sections of settings_file as dicts.
+
+        The resolved sections are cached as JSON next to the settings
+        file. The cache is used as long as its modification time equals
+        that of the settings file.
+        """
+        cache_file = settings_file + '.cache.json'
+        mtime = os.stat(settings_file).st_mtime_ns
+        try:
+            if os.stat(cache_file).st_mtime_ns == mtime:
+                with open(cache_file, 'r') as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        settings = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+        settings.read(settings_file)
+        config = {section: dict(settings.items(section))
+                  for section in settings.sections()}
+
+        # The cache is optional, e.g. the settings dir may be read-only
+        try:
+            with open(cache_file, 'w') as f:
+                json.dump(config, f)
+            os.utime(cache_file, ns=(mtime, mtime))
+        except OSError:
+            pass
+        return config
+
     def start_backups(self):
-        settings = self.settings
+        settings = self.config['general_settings']
+
+        # Every other section is a backup set
+        self.sections = [s for s in self.config if s != 'general_settings']
 
         # Get general backup settings (SSH settings, log files)
-        self.source_user = settings.get('general_settings', 'source_user')
-        self.source_host = settings.get('general_settings', 'source_host')
-        self.hwaddr = settings.get('general_settings', 'hwaddr')
+        self.source_user = settings['source_user']
+        self.source_host = settings['source_host']
+        self.hwaddr = settings['hwaddr']
+
+        self.target_user = settings['target_user']
+        self.target_host = settings['target_host']
+
+        self.backup_root = settings['backup_root']
+
+        # Prefixes for remote rsync locations, empty for local paths
+        self.source_prefix = self.get_remote_prefix(self.source_user, self.source_host)
+        self.target_prefix = self.get_remote_prefix(self.target_user, self.target_host)
+
+        # Link between source and target, decides the rsync transfer flags.
+        # With 'auto' it is decided once the source host answers.
+        self.transport = self.get_transport(settings.get('transport', 'auto'))
+
+        # Compression algorithm for the transfer, empty for the default
+        # of the transport and 'none' to disable it
+        self.compress = settings.get('compress', '')
+
+        # All ssh and rsync calls to a host share one master connection,
+        # the socket is named after a hash of user, host and port (%C).
+        # It lives in a private (0700) directory of this run, so no other
+        # user can put a socket in its place.
+        self.control_dir = tempfile.mkdtemp(prefix='pyrsync-')
+        self.ssh_options = [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(os.path.join(self.control_dir, '%C')),
+            '-o', 'ControlPersist=600'
+        ]
+        # A cipher with hardware support (AES-NI) keeps fast links
+        # network bound instead of CPU bound
+        if settings.get('ssh_cipher'):
+            self.ssh_options.extend(['-c', settings['ssh_cipher']])
+        self.ssh_servers = set()
+
+        # Whether a previous snapshot exists on the remote target, by path
+        self.link_dests = {}
+
+        # Seconds to wait for the source host after a wake-on-LAN packet
+        self.wake_timeout = float(settings.get('wake_timeout', WAKE_TIMEOUT))
 
-        self.target_user = settings.get('general_settings', 'target_user')
-        self.target_host = settings.get('general_settings', 'target_host')
+        # The source host is woken and checked once for all backup sets
+        self.host_lock = threading.Lock()
+        self.host_live = None
+        self.host_address = None
 
-        self.backup_root = settings.get('general_settings', 'backup_root')
+        # Snapshot folder of this run, holds the log and is linked as "current"
+        self.snapshot_dir = os.path.join(self.backup_root, self.new_id)
+
+        # One log file per run, written by a background thread
+        self.setup_logging(os.path.join(self.snapshot_dir, 'rsync-backup.log'))
 
         # The directory containing the identifiers for previous snapshots
         self.state_dir = os.path.join(self.backup_root, 'rsync-backup')
         # Create rsync-backup folder if not exists
-        if not os.path.exists(self.state_dir):
-            os.makedirs(self.state_dir)
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        # mkstemp creates owner-only files, new statefiles get the mode
+        # open() would give them. Read once, the umask is process wide.
+        umask = os.umask(0)
+        os.umask(umask)
+        self.state_mode = 0o666 & ~umask
+
+        # Statefiles of earlier versions are named by a SHA1 hash
+        self.migrate_states()
+
+        # Last backup date per source hash, read once for all backup sets
+        self.state_cache = self.read_states()
 
         # Exclude certain files defined in a exclude list
-        self.rsync_exclude_list = os.path.join(self.backup_root, 'rsync-exclude-list.txt')
+        self.rsync_exclude_list = self.compact_exclude_list(
+            os.path.join(self.backup_root, 'rsync-exclude-list.txt'))
 
-        # Loop over all backup sets
-        for section in settings.sections():
-            if section != 'general_settings':
-                new_id, update = self.backup(section)
+        # Write changed files in place instead of through a temporary file
+        self.inplace = self.getboolean('general_settings', 'inplace')
 
-        if update:
-            if self.dry_run:
-                print(c.WARNING + c.BOLD + '  * "--dry-run" detected, no update of symlink.' + c.ENDC)
-            else:
-                self.update_symlink(new_id)
-        if self.live and self.source_host and self.source_user:
-            self.send_message(title="Remote backup", subtitle="Finished", message="All backup tasks have finished")
+        # Log a line for every changed file, also when not on a terminal
+        self.verbose = self.getboolean('general_settings', 'verbose')
 
-    def backup(self, section):
-        """Do the actual backup routine."""
-        source_dir = self.settings.get(section, 'source_dir')
-        target_dir = self.settings.get(section, 'target_dir')
+        # Walk the source tree ahead of rsync to warm the inode cache
+        self.warmup = self.getboolean('general_settings', 'warmup')
 
-        # Set new backup date
-        new_id = self.get_new_id(target_dir)
+        # Number of backup sets which are run concurrently
+        jobs = int(settings.get('jobs', 4))
+
+        sections = self.sections
+        update = False
+        # Backup sets whose rsync failed, the other sets still run
+        self.failed = []
+        # Rotations are run one by one after all backup sets finished
+        rotations = []
+        try:
+            # Create the new snapshot folders of all backup sets at once
+            if self.dry_run is False:
+                self.prep_rsync([self.config[s]['target_dir'] for s in sections], self.new_id)
+
+            # Run all backup sets in a thread pool, each rsync runs in its
+            # own subprocess so the threads are only waiting on I/O
+            with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(sections)))) as executor:
+                futures = {executor.submit(self.backup, s): s for s in sections}
+                for future in as_completed(futures):
+                    try:
+                        _, section_update, live, rotation = future.result()
+                    except subprocess.CalledProcessError as e:
+                        self.logger.info(c.FAIL_BOLD + '  *** Backup of [{}] failed: {} ***'.format(futures[future], e) + c.ENDC)
+                        self.failed.append(futures[future])
+                        continue
+                    update = update or section_update
+                    self.live = self.live or live
+                    if rotation:
+                        rotations.append(rotation)
+
+            for target_dir, prev_target in rotations:
+                self.logger.info(c.WARNING_BOLD + '  * Starting rotation of {}'.format(target_dir) + c.ENDC)
+                rotate.start_rotation(path=target_dir, dry_run=False, exclude=prev_target)
+
+            if update:
+                if self.dry_run:
+                    print(c.WARNING_BOLD + '  * "--dry-run" detected, no update of symlink.' + c.ENDC)
+                elif self.failed:
+                    # "current" only points to a complete snapshot
+                    self.logger.info(c.FAIL_BOLD + '  * Backup of {} failed, no update of symlink.'.format(', '.join(self.failed)) + c.ENDC)
+                else:
+                    self.update_symlink()
+            if self.live and self.source_host and self.source_user:
+                self.send_message(title="Remote backup", subtitle="Finished", message="All backup tasks have finished")
+        finally:
+            self.close_ssh_masters()
 
-        log_file = os.path.join(self.backup_root, new_id, 'rsync-backup.log')
+    def backup(self, section):
+        """Do the actual backup routine.
 
-        logging.basicConfig(
-            format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
-            level=logging.INFO,
-            handlers=[
-                logging.FileHandler(log_file),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
-        self.logger = logging.getLogger("")
+        Runs in a worker thread and does not change shared state. Returns
+        the id, whether a backup was made, whether the source was live and
+        the (target_dir, prev_target) to rotate or None.
+        """
+        source_dir = self.config[section]['source_dir']
+        target_dir = self.config[section]['target_dir']
+
+        # Set new backup date
+        new_id = self.get_new_id()
 
         # retrieve last backup date
         prev_id = self.get_previous_id(source_dir)
 
-        self.logger.info(c.OKBLUE + c.BOLD + '  * Checking backup of' + c.ENDC)
-        self.logger.info('\tSource:\t{}'.format(self.settings.get(section, 'source_dir')) + c.ENDC)
-        self.logger.info('\tTarget:\t{}'.format(self.settings.get(section, 'target_dir')) + c.ENDC)
+        self.logger.info(c.OKBLUE_BOLD + '  * Checking backup of' + c.ENDC)
+        self.logger.info('\tSource:\t{}'.format(source_dir) + c.ENDC)
+        self.logger.info('\tTarget:\t{}'.format(target_dir) + c.ENDC)
+        new, live, rotation = False, False, None
         # Start backup if not performed today
         if new_id != prev_id:
 
             """Check if server is live"""
-            self.logger.info(c.OKBLUE + c.BOLD + '  * Checking if remote source is available' + c.ENDC)
+            self.logger.info(c.OKBLUE_BOLD + '  * Checking if remote source is available' + c.ENDC)
             # Check if a SSH connection is possible and the
             # provided directory is accesible, returns ssh object
-            self.live = self.__check_ssh__(host=self.source_host,
+            live = self.__check_ssh__(host=self.source_host,
                                username=self.source_user,
                                remote_dir=source_dir)
 
-            if self.live is True:
+            if live is True:
 
                 # Set target for new backup
                 subfolder = self.get_basename(source_dir)
@@ -143,160 +321,308 @@ class Backup():
                 # Set backup target
                 backup_target = self.get_backup_target(target_dir, new_id, subfolder)
 
-                self.start_rsync(prev_id,
-                                 new_id,
-                                 subfolder,
-                                 prev_target,
-                                 backup_source,
-                                 backup_target)
+                warmup = self.warmup_source(source_dir) if self.warmup else None
+
+                try:
+                    self.start_rsync(prev_id,
+                                     new_id,
+                                     subfolder,
+                                     prev_target,
+                                     backup_source,
+                                     backup_target)
+                finally:
+                    if warmup is not None:
+                        self.stop_warmup(warmup)
 
                 # Update current directory
                 if '--dry-run' in self.extra_arguments:
-                    self.logger.info(c.WARNING + c.BOLD + '  * "--dry-run" detected, no update of statefile.' + c.ENDC)
+                    self.logger.info(c.WARNING_BOLD + '  * "--dry-run" detected, no update of statefile.' + c.ENDC)
                     # rotate.start_rotation(path=target_dir, dry_run=True, exclude=prev_target)
                 else:
                     self.update_state(source_dir, new_id, target_dir)
-                    self.logger.info(c.WARNING + c.BOLD + '  * Starting rotation of backup_target' + c.ENDC)
-                    rotate.start_rotation(path=target_dir, dry_run=False, exclude=prev_target)
+                    rotation = (target_dir, prev_target)
 
                 new = True
         else:
             # No backup performed
-            self.logger.info(c.FAIL + c.BOLD + '  *** Backup is already perfomed today, skipping... ***\n' + c.ENDC)
-            new = False
+            self.logger.info(c.FAIL_BOLD + '  *** Backup is already perfomed today, skipping... ***\n' + c.ENDC)
+
+        return new_id, new, live, rotation
+
+    def getboolean(self, section, option, fallback=False):
+        """Return a boolean setting, accepting the ConfigParser spellings."""
+        value = self.config[section].get(option)
+        if value is None:
+            return fallback
+        if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+            raise ValueError('Not a boolean: {} = {}'.format(option, value))
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+    def setup_logging(self, log_file):
+        """Send log records through a queue.
+
+        The file and stdout handlers run in a QueueListener thread, so
+        logging from the backup threads only enqueues the record. The
+        queue is attached to the root logger so the records of
+        rotate-backups end up in the same log file.
+        """
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
 
-        return new_id, new
+        formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+        handlers = [
+            logging.FileHandler(log_file),
+            logging.StreamHandler(sys.stdout)
+        ]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(-1)
+        self.log_listener = QueueListener(log_queue, *handlers)
+        self.log_listener.start()
+        atexit.register(self.log_listener.stop)
+
+        root = logging.getLogger("")
+        root.setLevel(logging.INFO)
+        root.addHandler(QueueHandler(log_queue))
+
+        self.logger = logging.getLogger("pyrsync")
 
     def send_message(self, title, subtitle, message):
+        """Show a notification on the (macOS) source host."""
         ssh_server = '{}@{}'.format(self.source_user, self.source_host)
-        remote_cmd = "osascript -e 'display notification \"{message}\" with title \"{title} ({now})\" subtitle \"{subtitle}\"'".format(title=title, subtitle=subtitle, message=message, now=datetime.now().strftime('%d-%m-%Y %H:%M'))
-        ssh_cmd = ['ssh', ssh_server, remote_cmd]
-        subprocess.check_output(ssh_cmd)
-
-    def prep_rsync(self, target_dir, new_id):
-        """Create new subfolder."""
+        title = '{} ({})'.format(title, datetime.now().strftime('%d-%m-%Y %H:%M'))
+        script = 'display notification {} with title {} subtitle {}'.format(
+            self.__applescript_string__(message),
+            self.__applescript_string__(title),
+            self.__applescript_string__(subtitle))
+        remote_cmd = 'osascript -e {}'.format(shlex.quote(script))
+        subprocess.run(self.ssh_command(ssh_server, remote_cmd),
+                       stdout=subprocess.DEVNULL,
+                       check=True)
+
+    @staticmethod
+    def __applescript_string__(text):
+        """Quote text as an AppleScript string literal."""
+        return '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"'))
+
+    def ssh_command(self, ssh_server, remote_cmd, *options):
+        """Build ssh command which uses the shared master connection."""
+        self.ssh_servers.add(ssh_server)
+        return ['ssh'] + self.ssh_options + list(options) + [ssh_server, remote_cmd]
+
+    def rsync_shell(self):
+        """Remote shell option for rsync using the shared master connection."""
+        return '--rsh=ssh {}'.format(' '.join(self.ssh_options))
+
+    def close_ssh_masters(self):
+        """Stop the master connections opened during this run."""
+        for ssh_server in self.ssh_servers:
+            subprocess.run(['ssh'] + self.ssh_options + ['-O', 'exit', ssh_server],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        self.ssh_servers.clear()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def prep_rsync(self, target_dirs, new_id):
+        """Create new subfolder in every target dir."""
+        new_dirs = [str(PurePosixPath(target_dir, new_id)) for target_dir in dict.fromkeys(target_dirs)]
         if self.target_host and self.target_user:
-            # Remote target
-            new_dir = '{}@{}:{}'.format(self.target_user, self.target_host, os.path.join(target_dir,new_id))
-            subprocess.Popen(['rsync', '--quiet', '/dev/null', new_dir])
+            # Remote target, all folders in one ssh call
+            ssh_server = '{}@{}'.format(self.target_user, self.target_host)
+            remote_cmd = 'mkdir -p {}'.format(' '.join(shlex.quote(new_dir) for new_dir in new_dirs))
+            subprocess.run(self.ssh_command(ssh_server, remote_cmd), check=True)
         else:
             # Local target
-            new_dir = '{}'.format(os.path.join(target_dir,new_id))
-            if not os.path.exists(new_dir):
-                os.mkdir(new_dir)
+            for new_dir in new_dirs:
+                os.makedirs(new_dir, exist_ok=True)
 
-    def update_symlink(self, new_id):
-        self.logger.info(c.OKBLUE + c.BOLD + '  * Creating symlink "current" directory' + c.ENDC)
-        src = os.path.join(self.backup_root, new_id)
+    def update_symlink(self):
+        self.logger.info(c.OKBLUE_BOLD + '  * Creating symlink "current" directory' + c.ENDC)
+        src = self.snapshot_dir
         dst = os.path.join(self.backup_root, 'current')
+        # Create the link next to "current" and rename it over it, so
+        # "current" never disappears
+        tmp = dst + '.new'
         try:
-            os.unlink(dst)
-            os.symlink(src, dst)
-            self.logger.info(c.OKGREEN + c.BOLD + "    - Symlink created" + c.ENDC)
-        except:
-            os.symlink(src, dst)
-            self.logger.info(c.OKGREEN + c.BOLD + "    - Symlink created" + c.ENDC)
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        os.symlink(src, tmp)
+        os.replace(tmp, dst)
+        self.logger.info(c.OKGREEN_BOLD + "    - Symlink created" + c.ENDC)
 
     def update_state(self, source_dir, new_id, target_dir):
         """Retrieve last backup date for source dir."""
 
         source_hash = self.__create_hash__(source_dir)
-        self.logger.info(c.OKBLUE + c.BOLD + '  * Updating statefile with hash "{}" to {}'.format(source_hash, new_id) + c.ENDC)
+        self.logger.info(c.OKBLUE_BOLD + '  * Updating statefile with hash "{}" to {}'.format(source_hash, new_id) + c.ENDC)
 
+        # Write to a temporary file and rename it, a crash never leaves a
+        # truncated statefile (and a full backup without link-dest)
         state_file = os.path.join(self.state_dir, str(source_hash))
-        with open(state_file, 'w') as f:
-            f.write(new_id)
+        try:
+            mode = os.stat(state_file).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = self.state_mode
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.state_dir)
+        try:
+            os.fchmod(fd, mode)
+            os.write(fd, new_id.encode('UTF-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, state_file)
+        self.state_cache[source_hash] = new_id
+
+    def compact_exclude_list(self, exclude_list):
+        """Return the path of a compacted copy of exclude_list.
+
+        Comments, blank lines and duplicate rules are removed, so rsync
+        matches every file against fewer rules. The order of the rules is
+        kept, rsync uses the first matching rule. The copy is only rewritten
+        when the modification time of exclude_list changed.
+        """
+        compact_list = exclude_list + '.compact'
+        try:
+            mtime = os.stat(exclude_list).st_mtime_ns
+        except FileNotFoundError:
+            return exclude_list
+
+        try:
+            if os.stat(compact_list).st_mtime_ns == mtime:
+                return compact_list
+        except FileNotFoundError:
+            pass
+
+        rules = {}
+        with open(exclude_list, 'r') as f:
+            for line in f:
+                rule = line.rstrip('\r\n')
+                if rule.strip() and not rule.startswith(('#', ';')):
+                    rules[rule] = None
+
+        with open(compact_list, 'w') as f:
+            f.writelines(rule + '\n' for rule in rules)
+        os.utime(compact_list, ns=(mtime, mtime))
+        return compact_list
+
+    def migrate_states(self):
+        """Rename statefiles named by the SHA1 hash of a source_dir."""
+        for section in self.sections:
+            source_dir = self.config[section]['source_dir']
+            legacy_file = os.path.join(self.state_dir, hashlib.sha1(source_dir.encode('UTF-8')).hexdigest())
+            state_file = os.path.join(self.state_dir, self.__create_hash__(source_dir))
+            if os.path.exists(state_file):
+                continue
+            try:
+                os.replace(legacy_file, state_file)
+            except FileNotFoundError:
+                pass
+
+    def read_states(self):
+        """Read the last backup date from every statefile in state_dir."""
+        states = {}
+        for entry in os.scandir(self.state_dir):
+            # Skip temporary files left by an interrupted update_state
+            if entry.is_file() and not entry.name.startswith('.'):
+                with open(entry.path, 'r') as f:
+                    states[entry.name] = f.readline().rstrip()
+        return states
 
     def get_previous_id(self, source_dir):
         """Retrieve last backup date for source dir."""
-        self.logger.info(c.OKBLUE + c.BOLD + '  * Checking for last backup date' + c.ENDC)
+        self.logger.info(c.OKBLUE_BOLD + '  * Checking for last backup date' + c.ENDC)
         source_hash = self.__create_hash__(source_dir)
         self.logger.info('    - Source hash = {}'.format(source_hash))
 
-        state_file = os.path.join(self.state_dir, str(source_hash))
-        if os.path.isfile(state_file):
-            with open(state_file, 'r') as f:
-                line = f.readline()
-                self.logger.info('    - {}'.format(line.rstrip()))
-                return line
+        if source_hash in self.state_cache:
+            line = self.state_cache[source_hash]
+            self.logger.info('    - {}'.format(line))
+            return line
         else:
             self.logger.info(c.WARNING + '    - No statefile found' + c.ENDC)
             self.logger.info(c.FAIL + '    - No link-dest available' + c.ENDC)
             return ''
 
-    def get_new_id(self, target_dir):
-        """Generte new id based on current date."""
-        new_id = datetime.now().strftime('%Y-%m-%d')
+    def get_new_id(self):
+        """Return the id of this run, based on its start date."""
+        return self.new_id
 
-        if self.dry_run is False:
-            self.prep_rsync(target_dir, new_id)
-
-        return new_id
-
-    def __create_hash__(self, source_dir):
-        """Create SHA1 hash from source_dir name.
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def __create_hash__(source_dir):
+        """Create BLAKE2b hash from source_dir name.
 
         Used to store last backup date for that specific source dir.
         """
-        return hashlib.sha1(source_dir.encode('UTF-8')).hexdigest()
+        return hashlib.blake2b(source_dir.encode('UTF-8'), digest_size=10).hexdigest()
 
     def get_previous_target(self, target_dir, prev_id, subfolder):
         """Determine the previous backup target (to be used as link dest)."""
-        return os.path.join(target_dir, prev_id, subfolder)
+        return str(PurePosixPath(target_dir, prev_id, subfolder))
 
     def get_basename(self, source_dir):
         """Returns the basename of the source directory."""
-        return os.path.basename(os.path.normpath(source_dir))
+        return PurePosixPath(source_dir).name
+
+    def get_remote_prefix(self, user, host):
+        """Return "user@host:" for remote locations, else an empty string."""
+        if user and host:
+            return '{}@{}:'.format(user, host)
+        return ''
+
+    def get_transport(self, transport='auto'):
+        """Return 'lan' or 'wan' for the link rsync runs over.
+
+        A backup without a remote host is treated as LAN. Otherwise 'auto'
+        is kept until the source host answers, it may still be asleep and
+        not resolve yet (see get_link).
+        """
+        if transport in ('lan', 'wan'):
+            return transport
+        if transport != 'auto':
+            raise ValueError('transport must be auto, lan or wan, not "{}"'.format(transport))
+
+        if not self.source_prefix and not self.target_prefix:
+            return 'lan'
+        return 'auto'
+
+    def get_link(self, address):
+        """Return 'lan' for a private address, else 'wan'."""
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return 'wan'
+        return 'lan' if address.is_private else 'wan'
 
     def get_backup_source(self, source_dir):
         """if source_user and source_host are not blank.
 
         set backup source to remote location
         """
-        if self.source_user and self.source_host:
-            backup_source = '{}@{}:{}'.format(self.source_user, self.source_host, source_dir)
-        else:
-            backup_source = source_dir
-
-        return backup_source
+        return self.source_prefix + source_dir
 
     def get_backup_target(self, target_dir, new_id, subfolder):
         # if target_user and target_host are not blank,
         # set backup source to remote location
-        backup_path = os.path.join(target_dir, new_id, subfolder)
-        if self.target_user and self.target_host:
-            backup_target = '{}@{}:{}'.format(self.target_user, self.target_host, backup_path)
-        else:
-            backup_target = backup_path
-
-        return backup_target
-
-    def get_log_date(self):
-        # Get timestamp for last modification
-        if os.path.isfile(self.log_file):
-            mod_time = os.path.getmtime(self.log_file)
-
-            # Return string in Y-m-d format
-            return datetime.fromtimestamp(mod_time).strftime('%Y-%m-%d')
-        else:
-            return ''
+        return self.target_prefix + str(PurePosixPath(target_dir, new_id, subfolder))
 
     def __check_ssh__(self, host='', username='', remote_dir=''):
         """Check if server is live"""
         live = self.__ipcheck__(host, self.hwaddr)
         """Check is ssh connection can be made to source."""
-        self.logger.info(c.OKBLUE + c.BOLD + '  * Checking SSH connection to remote source' + c.ENDC)
+        self.logger.info(c.OKBLUE_BOLD + '  * Checking SSH connection to remote source' + c.ENDC)
         if host and username and remote_dir and live:
             ssh_server = '{}@{}'.format(username, host)
-            ssh_cmd = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=5', ssh_server, 'echo ok']
+            # Check the connection and the directory in one round trip
+            remote_cmd = 'echo ok; [ -d {} ] && echo dir'.format(shlex.quote(remote_dir))
+            ssh_cmd = self.ssh_command(ssh_server, remote_cmd, '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=5')
 
-            ssh = subprocess.check_output(ssh_cmd).decode('utf-8').strip()
-            if ssh == 'ok':
+            ssh = subprocess.run(ssh_cmd, stdout=subprocess.PIPE, universal_newlines=True)
+            reply = ssh.stdout.split()
+            if 'ok' in reply:
                 self.logger.info(c.OKGREEN + '    - SSH connection established' + c.ENDC)
-                ssh_cmd = ['ssh', ssh_server, '[ ! -d \'{}\' ]'.format(remote_dir)]
-                ssh = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE)
-                ssh.communicate()[0]
-                if ssh.returncode == 1:
+                if 'dir' in reply:
                     self.logger.info(c.OKGREEN + '    - Directory "{}" exists'.format(remote_dir) + c.ENDC)
                     return True
                 else:
@@ -310,49 +636,192 @@ class Backup():
             return False
 
     def __ipcheck__(self, host, hwaddr):
+        """Check server status once, all backup sets share the result."""
+        with self.host_lock:
+            if self.host_live is None:
+                self.host_live = self.__wakeup__(host, hwaddr)
+                # Decide the transport by the address that answered
+                if self.host_live and self.transport == 'auto':
+                    self.transport = self.get_link(self.host_address)
+                    self.logger.info('    - Transport: {}'.format(self.transport))
+        return self.host_live
+
+    def __wakeup__(self, host, hwaddr):
         """Check server status.
-        Checks if server is available by sending a ping.
-        If the response is false, upto 5 WOL commands will be send.
+        Checks if server is available by connecting to the SSH port.
+        If the connection fails, a WOL command is send and the SSH port
+        is polled every 0.5 seconds until wake_timeout has passed.
         """
-        status,result = subprocess.getstatusoutput("ping -w2 " + str(host))
-        if status != 0:
-            for cnt in range(0,5):
-                self.logger.info(c.FAIL + '    - Trying to wake remote host' + c.ENDC)
-                send_magic_packet(str(hwaddr))
-                status,result = subprocess.getstatusoutput("ping -w10 " + str(host))
-                if status == 0:
-                    break
-
-        if status == 0:
+        if self.__tcpcheck__(host, timeout=2):
             return True
-        else:
-            self.logger.info(c.FAIL + '    - Server seems down' + c.ENDC)
+
+        self.logger.info(c.FAIL + '    - Trying to wake remote host' + c.ENDC)
+        send_magic_packet(str(hwaddr))
+        deadline = time.monotonic() + self.wake_timeout
+        while time.monotonic() < deadline:
+            if self.__tcpcheck__(host, timeout=1):
+                return True
+            time.sleep(0.5)
+
+        self.logger.info(c.FAIL + '    - Server seems down' + c.ENDC)
+        return False
+
+    def __tcpcheck__(self, host, port=SSH_PORT, timeout=2):
+        """Check if a TCP connection can be made to host.
+
+        The address that answered is kept in host_address.
+        """
+        try:
+            with socket.create_connection((host, port), timeout=timeout) as conn:
+                self.host_address = conn.getpeername()[0]
+            return True
+        except OSError:
+            return False
+
+    def warmup_source(self, source_dir):
+        """Walk source_dir in the background so rsync finds its inodes cached.
+
+        The remote source is walked with find over ssh, the process is
+        returned so it can be stopped once rsync is done. The output of
+        find stays on the remote side. find runs until stdin of the ssh
+        client is closed (or the client is terminated), then it is killed.
+        """
+        self.logger.info(c.OKBLUE_BOLD + '  * Warming up source directory' + c.ENDC)
+        ssh_server = '{}@{}'.format(self.source_user, self.source_host)
+        remote_cmd = 'find {} -xdev > /dev/null 2>&1 & cat > /dev/null; kill $!'.format(shlex.quote(source_dir))
+        return subprocess.Popen(self.ssh_command(ssh_server, remote_cmd),
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+
+    def stop_warmup(self, warmup):
+        """Stop the remote find by closing stdin of its ssh client."""
+        warmup.stdin.close()
+        try:
+            warmup.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            warmup.terminate()
+            warmup.wait()
+
+    def seed_with_cp(self, prev_id, prev_target, backup_target):
+        """Seed a local target with a hard-link copy of the previous snapshot.
+
+        cp -al builds the link tree much faster than rsync --link-dest,
+        rsync then only has to transfer the changes. Returns True when
+        the target was seeded.
+        """
+        if self.target_prefix or not prev_id or self.dry_run:
+            return False
+        if not os.path.isdir(prev_target) or os.path.exists(backup_target):
             return False
 
+        self.logger.info(c.OKBLUE_BOLD + '  * Seeding target with hard links to {}'.format(prev_target) + c.ENDC)
+        subprocess.run(['cp', '-al', prev_target, os.path.dirname(backup_target)], check=True)
+        return True
+
+    def link_dest_exists(self, prev_id, prev_target):
+        """Check if the previous snapshot exists on the target.
+
+        Remote targets are checked over ssh, the result is kept for the
+        rest of the run.
+        """
+        if not prev_id:
+            return False
+        if not self.target_prefix:
+            return os.path.isdir(prev_target)
+
+        if prev_target not in self.link_dests:
+            self.link_dests[prev_target] = self.target_dir_exists(prev_target)
+        return self.link_dests[prev_target]
+
+    def target_dir_exists(self, path):
+        """Check if path is a directory on the (local or remote) target."""
+        if not self.target_prefix:
+            return os.path.isdir(path)
+
+        ssh_server = '{}@{}'.format(self.target_user, self.target_host)
+        remote_cmd = 'test -d {}'.format(shlex.quote(path))
+        test = subprocess.run(self.ssh_command(ssh_server, remote_cmd))
+        return test.returncode == 0
+
+    def __log_output__(self, p):
+        """Log stdout and stderr of process p while it runs.
+
+        Both pipes are read together in 64 KiB chunks, so rsync never
+        blocks on a full stderr pipe while stdout is being read. Only
+        complete lines are decoded and logged.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(p.stdout, selectors.EVENT_READ, ('', ''))
+        selector.register(p.stderr, selectors.EVENT_READ, (c.FAIL, c.ENDC))
+        pending = {p.stdout: b'', p.stderr: b''}
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, 1 << 16)
+                if data:
+                    *lines, pending[key.fileobj] = (pending[key.fileobj] + data).split(b'\n')
+                else:
+                    # End of output, log the unterminated last line
+                    selector.unregister(key.fileobj)
+                    lines = [pending[key.fileobj]] if pending[key.fileobj] else []
+
+                start, end = key.data
+                for line in lines:
+                    self.logger.info(start + line.decode('utf-8', 'replace') + end)
+
+        selector.close()
+
     def start_rsync(self, prev_id, new_id, subfolder, prev_target, backup_source, backup_target):
         arguments = [
-            "rsync",
-            "--recursive",
-            "--links",
-            "--times",
-            "--itemize-changes",
-            "--devices",
-            "--specials",
-            "--delete",
-            "--human-readable",
-            "--delete-excluded",
-            "--ignore-existing",
-            "--stats"
+            *RSYNC_BASE,
+            # Add exclude list to arguments
+            "--exclude-from={}".format(self.rsync_exclude_list)
         ]
 
-        # Add exclude list to arguments
-        arguments.append("--exclude-from={}".format(self.rsync_exclude_list))
+        # One line per changed file is only useful when someone watches,
+        # or when it is asked for (also possible with extra arguments)
+        if self.verbose or sys.stdout.isatty():
+            arguments.append("--itemize-changes")
+
+        # On a LAN the delta algorithm costs more CPU than it saves in bytes
+        if self.transport == 'lan':
+            arguments.append("--whole-file")
+
+        # Compress on a WAN unless the compression is set explicitly
+        if self.compress == 'none' or (not self.compress and self.transport == 'lan'):
+            arguments.append("--no-compress")
+        elif self.compress:
+            arguments.extend(["--compress", "--compress-choice={}".format(self.compress)])
+        else:
+            arguments.append("--compress")
+
+        # Run the remote shell over the shared master connection
+        arguments.append(self.rsync_shell())
 
         # Add extra arguments to arguments list
         arguments.extend(self.extra_arguments)
 
-        # Add link destination to arguments
-        arguments.append("--link-dest={}".format(prev_target))
+        # When seeded, unchanged files are already linked. Changed files
+        # are replaced by rsync (never updated in place, which would also
+        # change the previous snapshot through the shared inode).
+        if not self.seed_with_cp(prev_id, prev_target, backup_target):
+            # Add link destination to arguments, rsync silently copies
+            # everything when the link destination does not exist
+            if self.link_dest_exists(prev_id, prev_target):
+                arguments.append("--link-dest={}".format(prev_target))
+            else:
+                self.logger.info(c.WARNING + '    - No previous snapshot at {}, full copy'.format(prev_target) + c.ENDC)
+
+            # Writing in place is only safe in a folder created by this
+            # run. A target left by an earlier failed run already holds
+            # hard links to the previous snapshot, writing into those
+            # would change that snapshot too.
+            if self.inplace:
+                if self.target_dir_exists(backup_target[len(self.target_prefix):]):
+                    self.logger.info(c.WARNING + '    - Target exists from an earlier run, not writing in place' + c.ENDC)
+                else:
+                    arguments.append("--inplace")
 
         # Add backup source
         arguments.append(backup_source)
@@ -360,7 +829,7 @@ class Backup():
         # Add backup target
         arguments.append(backup_target)
 
-        self.logger.info(c.HEADER + c.BOLD + '  * Backup configuration:' + c.ENDC)
+        self.logger.info(c.HEADER_BOLD + '  * Backup configuration:' + c.ENDC)
         self.logger.info('    - Source Directory   : {}'.format(backup_source))
         self.logger.info('    - Target Directory   : {}'.format(backup_target))
         self.logger.info('    - Previous Directory : {}'.format(prev_target))
@@ -368,7 +837,7 @@ class Backup():
         self.logger.info('    - New snapshot       : {}'.format(new_id))
         self.logger.info('    - Snapshot subfolder : {}'.format(subfolder))
         self.logger.info('    - Extra rsync options: {}'.format(self.extra_arguments))
-        self.logger.info(c.HEADER + c.BOLD + '  * Running rsync with:' + c.ENDC)
+        self.logger.info(c.HEADER_BOLD + '  * Running rsync with:' + c.ENDC)
         for arg in arguments[1:]:
         	self.logger.info('    {}'.format(arg))
 
@@ -379,23 +848,13 @@ class Backup():
         # Start backup...
         with subprocess.Popen(arguments,
                               stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              bufsize=1,
-                              universal_newlines=False) as p:
-
-            for line in p.stdout:
-                self.logger.info(line)
-            for line in p.stderr:
-                self.logger.info(c.FAIL + line + c.ENDC)
+                              stderr=subprocess.PIPE) as p:
+            self.__log_output__(p)
 
         if p.returncode != 0:
             raise subprocess.CalledProcessError(p.returncode, p.args)
-            self.logfile.close()
-            self.errlogfile.close()
 
 
 if __name__ == '__main__':
-    try:
-        Backup(settings_file=sys.argv[1], extra_arguments=sys.argv[2:])
-    except:
-        Backup(settings_file=sys.argv[1], extra_arguments=[])
+    from .__main__ import main
+    main()
@@ -15,25 +15,44 @@ from rotate_backups import (
 # Initialize a logger.
 logger = VerboseLogger(__name__)
 
+# Default retention periods, coerced once for every rotation.
+ROTATION_DEFAULTS = dict(daily=7, weekly=4, monthly=4, yearly='always')
+_ROTATION_SCHEME = {period: coerce_retention_period(value)
+                    for period, value in ROTATION_DEFAULTS.items()}
+
+# Logging is configured by the first rotation only.
+_installed = False
+
+
+def install_logging():
+    """Install coloredlogs once per process."""
+    global _installed
+    if not _installed:
+        coloredlogs.install(syslog=True)
+        _installed = True
+
 
 def start_rotation(daily=7, weekly=4, monthly=4, yearly='always',
                    path='', use_sudo=False, strict=False, dry_run=False,
-                   exclude=''):
+                   exclude='', rotation_scheme=None):
     """Command line interface for the ``rotate-backups`` program."""
-    coloredlogs.install(syslog=True)
+    install_logging()
 
     # Command line option defaults.
-    rotation_scheme = {}
     kw = dict(include_list=[], exclude_list=[])
 
     # Internal state.
     selected_locations = []
 
-    # Parse the command line arguments.
-    rotation_scheme['daily'] = coerce_retention_period(daily)
-    rotation_scheme['weekly'] = coerce_retention_period(weekly)
-    rotation_scheme['monthly'] = coerce_retention_period(monthly)
-    rotation_scheme['yearly'] = coerce_retention_period(yearly)
+    # Parse the command line arguments, the default periods are
+    # already coerced.
+    if rotation_scheme is None:
+        periods = dict(daily=daily, weekly=weekly, monthly=monthly, yearly=yearly)
+        if periods == ROTATION_DEFAULTS:
+            rotation_scheme = _ROTATION_SCHEME.copy()
+        else:
+            rotation_scheme = {period: coerce_retention_period(value)
+                               for period, value in periods.items()}
 
     # --relaxed mode (Fuzzy date matching)
     kw['strict'] = strict
@@ -44,8 +63,7 @@ def start_rotation(daily=7, weekly=4, monthly=4, yearly='always',
 
     # Perform a dry run
     kw['dry_run'] = dry_run
-        
-    print(kw)
+
     if path:
         selected_locations.append(coerce_location(path, sudo=use_sudo))
         # selected_locations.extend(coerce_location(path, sudo=use_sudo))